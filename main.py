@@ -23,14 +23,21 @@
 # Imports                                                                     #
 ###############################################################################
 import argparse
+import atexit
 import csv
+import gc
 import jinja2
 import logging
+import logging.handlers
 import os
 import paramiko
 import re
+import shelve
 import smtplib
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from dotenv import load_dotenv
 from email.mime.multipart import MIMEMultipart
@@ -52,207 +59,197 @@ drive_types = [
     'DISK'
 ]
 
+# Storing the amount of hosts after which the garbage collector runs, while the
+#  results of the hosts get processed
+gc_interval = 10
+
+# Storing the response cache and its TTL in seconds. The cache is only used when
+#  CACHE_TTL is set in the ENV file. The lock guards the cache, because the hosts
+#  get queried from multiple threads
+response_cache = None
+response_cache_lock = threading.Lock()
+cache_ttl = 0
+
+# Storing the Jinja2 environments per template directory, so compiled templates
+#  get reused
+jinja_envs = {}
+
+# Storing the line that separates the output of the drives when the commands for
+#  all drives of a host get combined into a single command
+output_separator = '===SPLIT==='
+
+# Storing the maximum amount of ESXi hosts that get queried in parallel
+ssh_pool_size = 10
+
+# Storing the options for SSH connections to ESXi hosts. Esxi-getsmart only uses
+#  password authentication, so local SSH keys and the SSH agent don't get probed.
+#  The CBC and 3DES ciphers are disabled, so the transport always uses AES-CTR,
+#  which the cryptography library runs on the CPU's AES instructions
+ssh_connect_options = {
+    'look_for_keys': False,
+    'allow_agent': False,
+    'compress': False,
+    'banner_timeout': 5,
+    'disabled_algorithms': {
+        'ciphers': ['3des-cbc', 'aes128-cbc', 'aes192-cbc', 'aes256-cbc']
+    }
+}
+
+# Storing the SSH connections per host and user, so connections get reused for
+#  every command that runs on the same host. The lock guards the dictionaries,
+#  because the hosts get queried from multiple threads. Every host and user also
+#  gets its own lock, which is held while connecting, so two workers for the same
+#  host never set up two connections
+ssh_pool = {}
+ssh_pool_locks = {}
+ssh_pool_lock = threading.Lock()
+
 
 ###############################################################################
 # Main                                                                        #
 ###############################################################################
 def main():
-    # Grabbing the current time for later processing
+    # Grabbing the current time for later processing. The formatted date and time
+    #  only get computed once and are reused for the rest of the run
     start_time = datetime.now()
-    print("########## Starting netbackup at " + get_date() + "-" + get_time() + " ##########")
+    run_date = get_date(start_time)
+    run_time = get_time(start_time)
 
     # Reading the arguments that the script needs to run with,
     #  to determine the LOG, BCK, CSV, ENV and REP paths
     args = read_args()
-    print("########## Log path: " + args.log + " ##########")
-    print("########## CSV path: " + args.csv + " ##########")
-    print("########## ENV path: " + args.env + " ##########")
-    print("########## REP path: " + args.rep + " ##########")
+
+    # Printing the start banner in a single write
+    banner = [
+        f"########## Starting netbackup at {run_date}-{run_time} ##########",
+        f"########## Log path: {args.log} ##########",
+        f"########## CSV path: {args.csv} ##########",
+        f"########## ENV path: {args.env} ##########",
+        f"########## REP path: {args.rep} ##########"
+    ]
+    print("\n".join(banner))
 
     # Configuring the logging module
-    logfile =  args.log + get_date() + '-esxitools-log.txt'
-    logging.basicConfig(level=logging.INFO, filename=logfile, format='%(asctime)s - %(levelname)s - %(message)s')
-    logging.info("########## Starting netbackup at " + get_date() + "-" + get_time() + " ##########")
+    logfile = f"{args.log}{run_date}-esxitools-log.txt"
+    configure_logging(logfile)
+    logging.info(f"########## Starting netbackup at {run_date}-{run_time} ##########")
 
     # Loading the env vars
     load_dotenv_file(args.env)
-    logging.info("########## Loaded ENV file for organization " + os.getenv('ORG') + " ##########")
+    logging.info(f"########## Loaded ENV file for organization {os.getenv('ORG')} ##########")
+
+    # Opening the response cache in the log directory if CACHE_TTL is set in the env vars.
+    #  CACHE_TTL needs to be a whole amount of seconds, a TTL of 0 disables the cache
+    if os.getenv('CACHE_TTL'):
+        if not os.getenv('CACHE_TTL').isdigit():
+            e = "########## Something wrong with CACHE_TTL ##########"
+            logging.error(e)
+            exit(e)
+        if int(os.getenv('CACHE_TTL')) > 0:
+            open_cache(os.path.join(args.log, 'smart_cache.db'), int(os.getenv('CACHE_TTL')))
+            logging.info(f"########## Using the response cache with a TTL of {cache_ttl} seconds ##########")
 
     # Dictionary that will hold data for each server specified in the input CSV
     servers = {}
 
-    # Reading the input CSV and doing stuff for each entry
+    # Dictionary that will hold the CSV entries grouped per host, so every host
+    #  only needs a single SSH connection for all of its drives
+    hosts = {}
+
+    # Reading the input CSV and grouping the entries per host
     csv_content = load_csv_file(args.csv)
     logging.info("########## Loaded the CSV file ##########")
     logging.info("")
     for row in csv_content:
-        logging.info("########## Starting CSV iteration for " + row[0] + " drive " + row[3] + " ##########")
-
-        # Setting esxi_user to the default user, optionally overriding this
-        #  depending on the ENV file
-        esxi_user = default_esxi_user
-        if os.getenv('ESXI_USER') is not esxi_user:
-            esxi_user = os.getenv('ESXI_USER')
-
-        # Validating drive type input
-        if row[2] not in drive_types:
-            logging.info("########## Unsupported drive type ##########")
-            print("########## Unsupported drive type ##########")
-
-        # Storing the command status for the ESXi SSH command. If succesful, this gets changed later
-        command_status = 'Not OK'
-
-        # Creating a dictionary with S.M.A.R.T. data for this drive
-        smart_data = {}
-        smart_data['Drive Type'] = row[2]
-        smart_data['Drive Name'] = row[3]
-        smart_data['Health Status'] = 'OK'
-
-        # Retrieving the S.M.A.R.T. data. The command and properties depend on the drive type
-        match row[2]:
-            case 'NVME':
-                # Setting the NVME command
-                command = "esxcli nvme device log smart get -A " + row[3]
-
-                # Running the command and storing the output and command status
-                output = esxi_command(row[1], esxi_user, os.getenv('ESXI_PASS'), command)
-                command_status = output[1]
-
-                # Parsing the output line by line, stripping, splitting and converting
-                #  until all required properties are selected. The properties get stored
-                #  in the smart_data dictionary for the specified drive
-                for line in output[0]:
-                    line = line.strip().split(':')
-                    if line[0] == 'NVM Subsystem Reliability Degradation':
-                        smart_data[line[0]] = line[1].strip()
-                    if line[0] == 'Volatile Memory Backup Device Failure':
-                        smart_data[line[0]] = line[1].strip()
-                    if line[0] == 'Composite Temperature':
-                        temp = int(round(float(line[1].split()[0]) - 273.15))
-                        smart_data['Drive Temperature (Celcius)'] = temp
-                    if line[0] == 'Available Spare':
-                        pct = int(line[1].split('%')[0].strip())
-                        smart_data[line[0] + ' (%)'] = pct
-                    if line[0] == 'Available Spare Threshold':
-                        pct = int(line[1].split('%')[0].strip())
-                        smart_data[line[0] + ' (%)'] = pct
-                    if line[0] == 'Percentage Used':
-                        pct = int(line[1].split('%')[0].strip())
-                        smart_data[line[0] + ' (%)'] = pct
-                    if line[0] == 'Unsafe Shutdowns':
-                        amount = int(line[1].strip()[2:], 16)
-                        smart_data[line[0]] = amount
-                    if line[0] == 'Media Errors':
-                        amount = int(line[1].strip()[2:], 16)
-                        smart_data[line[0]] = amount
-                    if line[0] == 'Number of Error Info Log Entries':
-                        amount = int(line[1].strip()[2:], 16)
-                        smart_data[line[0]] = amount
-                if smart_data['Available Spare (%)'] <= smart_data['Available Spare Threshold (%)']:
-                    smart_data['Health Status'] = 'Not OK'
-
-            case 'SATA':
-                # Setting the SATA command
-                command = "esxcli storage core device smart get -d " + row[3]
-
-                # Running the command and storing the output and command status
-                output = esxi_command(row[1], esxi_user, os.getenv('ESXI_PASS'), command)
-                command_status = output[1]
-
-                # Parsing the output line by line, stripping, splitting and converting
-                #  until all required properties are selected. The properties get stored
-                #  in the smart_data dictionary for the specified drive
-                for line in output[0]:
-                    if 'Health Status' in line:
-                        health_status = line.strip('Health Status').split()[0]
-                        smart_data['Health Status'] = health_status
-                    if 'Drive Temperature' in line:
-                        temp = line.strip('Drive Temperature').split()[3]
-                        smart_data['Drive Temperature (Celcius)'] = temp
-                    if 'Media Wearout Indicator' in line:
-                        count = line.strip('Media Wearout Indicator').split()[3]
-                        smart_data['Media Wearout Indicator'] = count
-                    if 'Reallocated Sector Count' in line:
-                        count = line.strip('Reallocated Sector Count').split()[3]
-                        smart_data['Reallocated Sector Count'] = count
-                    if 'Write Sectors TOT Count' in line:
-                        count = line.strip('Write Sectors TOT Count').split()[3]
-                        smart_data['Write Sectors TOT Count'] = count
-                    if 'Read Sectors TOT Count' in line:
-                        count = line.strip('Read Sectors TOT Count').split()[3]
-                        smart_data['Read Sectors TOT Count'] = count
-                    if 'Initial Bad Block Count' in line:
-                        count = line.strip('Initial Bad Block Count').split()[3]
-                        smart_data['Initial Bad Block Count'] = count
-                    if 'Program Fail Count' in line:
-                        count = line.strip('Program Fail Count').split()[3]
-                        smart_data['Program Fail Count'] = count
-                    if 'Erase Fail Count' in line:
-                        count = line.strip('Erase Fail Count').split()[3]
-                        smart_data['Erase Fail Count'] = count
-                    if 'Uncorrectable Error Count' in line:
-                        count = line.strip('Uncorrectable Error Count').split()[3]
-                        smart_data['Uncorrectable Error Count'] = count
-                    if 'Pending Sector Reallocation Count' in line:
-                        count = line.strip('Pending Sector Reallocation Count').split()[3]
-                        smart_data['Pending Sector Reallocation Count'] = count
-
-            case 'DISK':
-                # Setting the DISK command
-                command = "esxcli storage core device smart get -d " + row[3]
-
-                # Running the command and storing the output and command status
-                output = esxi_command(row[1], esxi_user, os.getenv('ESXI_PASS'), command)
-                command_status = output[1]
-
-                # Parsing the output line by line, stripping, splitting and converting
-                #  until all required properties are selected. The properties get stored
-                #  in the smart_data dictionary for the specified drive
-                for line in output[0]:
-                    if 'Health Status' in line:
-                        health_status = line.strip('Health Status').split()[0]
-                        smart_data['Health Status'] = health_status
-                    if 'Drive Temperature' in line:
-                        temp = line.strip('Drive Temperature').split()[3]
-                        smart_data['Drive Temperature (Celcius)'] = temp
-                    if 'Read Error Count' in line:
-                        count = line.strip('Read Error Count').split()[3]
-                        smart_data['Read Error Count'] = count
-                    if 'Reallocated Sector Count' in line:
-                        count = line.strip('Reallocated Sector Count').split()[3]
-                        smart_data['Reallocated Sector Count'] = count
-                    if 'Sector Reallocation Event Count' in line:
-                        count = line.strip('Sector Reallocation Event Count').split()[3]
-                        smart_data['Sector Reallocation Event Count'] = count
-                    if 'Pending Sector Reallocation Count' in line:
-                        count = line.strip('Pending Sector Reallocation Count').split()[3]
-                        smart_data['Pending Sector Reallocation Count'] = count
-                    if 'Uncorrectable Sector Count' in line:
-                        count = line.strip('Uncorrectable Sector Count').split()[3]
-                        smart_data['Uncorrectable Sector Count'] = count
+        server, host, drive_type, drive_name = row[0], row[1], row[2], row[3]
+
+        # Validating drive type input, skipping drives that aren't supported
+        if drive_type not in drive_types:
+            logging.info(f"########## Unsupported drive type for {server} drive {drive_name} ##########")
+            continue
 
         # Creating a key value for the specified server. If this server is not already in the servers
-        #  dictionary, it gets added
-        server_key = row[0] + ' (' + row[1] + ')'
+        #  dictionary, it gets added. This keeps the servers in the same order as the CSV file
+        server_key = f"{server} ({host})"
         if server_key not in servers:
-            server = {server_key: []}
             servers[server_key] = []
-
-        # If the SSH command ran successfully, the data for this device gets added to the servers
-        #  dictionary under the corresponding server
-        if command_status == 'OK':
-            servers[server_key].append(smart_data)
-        else:
-            logging.info("########## Command for " + row[0] + ", drive " + row[3] + " unsuccessful ##########")
-            break
-
-        logging.info("########## Command for " + row[0] + ", drive " + row[3] + " successful ##########")
+            hosts[server_key] = []
+        hosts[server_key].append(row)
+
+    # Setting esxi_user to the default user, optionally overriding this
+    #  depending on the ENV file. The credentials are the same for every host,
+    #  so they only get read once
+    esxi_user = os.getenv('ESXI_USER') or default_esxi_user
+    esxi_pass = os.getenv('ESXI_PASS')
+
+    # Creating a dictionary with the variables that the report mailer needs if USE_SMTP
+    #  is set to 'yes' in the env vars. The body gets added once the report is rendered
+    mail_vars = None
+    if os.getenv('USE_SMTP') == 'yes':
+        mail_vars = {}
+        mail_vars['smtp_host'] = os.getenv('SMTP_HOST')
+        mail_vars['smtp_port'] = os.getenv('SMTP_PORT')
+        mail_vars['smtp_user'] = os.getenv('SMTP_USER')
+        mail_vars['smtp_pass'] = os.getenv('SMTP_PASS')
+        mail_vars['from'] = os.getenv('SMTP_FROM')
+        mail_vars['to'] = os.getenv('SMTP_TO')
+        mail_vars['subject'] = f"ESXI getsmart report for {os.getenv('ORG')} at {run_date}"
+
+    # Querying all hosts in parallel. Every host gets its own worker, which runs the
+    #  commands for all drives of that host over a single SSH connection
+    with ThreadPoolExecutor(max_workers=ssh_pool_size) as executor:
+        # Setting up the SMTP connection in the background while the hosts get queried,
+        #  so it's ready by the time the report needs to be sent
+        mailserver_future = None
+        if mail_vars:
+            mailserver_future = executor.submit(connect_mail, mail_vars)
+
+        futures = set()
+        for server_key, rows in hosts.items():
+            logging.info(f"########## Starting SSH queries for {server_key} ##########")
+            futures.add(executor.submit(query_host, server_key, rows, esxi_user, esxi_pass))
+
+        # Processing the results of every host as soon as its worker is finished
+        for count, future in enumerate(as_completed(futures), 1):
+            server_key, results = future.result()
+            for row, output, command_status in results:
+                server, drive_type, drive_name = row[0], row[2], row[3]
+
+                # Creating a dictionary with S.M.A.R.T. data for this drive
+                smart_data = {}
+                smart_data['Drive Type'] = drive_type
+                smart_data['Drive Name'] = drive_name
+                smart_data['Health Status'] = 'OK'
+
+                # If the SSH command didn't run successfully, this drive gets skipped
+                if command_status != 'OK':
+                    logging.info(f"########## Command for {server}, drive {drive_name} unsuccessful ##########")
+                    continue
+
+                # Parsing the S.M.A.R.T. data with the parser for the drive type
+                smart_data.update(parsers[drive_type](output))
+
+                # The data for this device gets added to the servers dictionary under the
+                #  corresponding server
+                servers[server_key].append(smart_data)
+                logging.info(f"########## Command for {server}, drive {drive_name} successful ##########")
+
+            # Releasing the raw output of this host now that it's parsed, and running the
+            #  garbage collector after every gc_interval hosts to keep memory use flat
+            del results
+            futures.discard(future)
+            if count % gc_interval == 0:
+                gc.collect(generation=1)
+
+    # Closing the SSH connections and the response cache, now that all hosts have been queried
+    close_all()
+    close_cache()
 
     # Creating a dictionary with the variables that the status report needs
     report_vars = {}
     report_vars['org'] = os.getenv('ORG')
-    report_vars['date'] = get_date()
-    report_vars['servers'] = servers
+    report_vars['date'] = run_date
+    report_vars['servers'] = {server_key: to_columns(drives) for server_key, drives in servers.items()}
     #pprint(report_vars)
 
     # Rendering the status report
@@ -260,80 +257,299 @@ def main():
     report = render_report(report_vars, args.rep)
     #print(report)
 
-    # E-Mail the status report if USE_SMTP is set to 'yes' in the env vars
-    if os.getenv('USE_SMTP') == 'yes':
-        # Creating a dictionary with the variables that the report mailer needs
-        mail_vars = {}
-        mail_vars['smtp_host'] = os.getenv('SMTP_HOST')
-        mail_vars['smtp_port'] = os.getenv('SMTP_PORT')
-        mail_vars['smtp_user'] = os.getenv('SMTP_USER')
-        mail_vars['smtp_pass'] = os.getenv('SMTP_PASS')
-        mail_vars['from'] = os.getenv('SMTP_FROM')
-        mail_vars['to'] = os.getenv('SMTP_TO')
-        mail_vars['subject'] = 'ESXI getsmart report for ' + os.getenv('ORG') + ' at ' + get_date()
+    # E-Mail the status report over the SMTP connection that was set up in the background
+    if mail_vars:
         mail_vars['body'] = report
 
         # E-Mailing the status report
         logging.info("########## Sending the report ##########")
-        send_mail(mail_vars)
-
-    # Logging the end of the script execution
-    logging.info("########## Finished esxitools at " + get_date() + "-" + get_time() + "##########")
-    print("########## Finished esxitools at " + get_date() + "-" + get_time() + "##########")
+        send_mail(mail_vars, mailserver_future.result())
 
-    # Printing the script execution time
+    # Grabbing the current time to determine the execution time
     end_time = datetime.now()
-    logging.info(f"########## Total execution time: {end_time - start_time} ##########")
-    print(f"########## Total execution time: {end_time - start_time} ##########")
+
+    # Logging and printing the end of the script execution and the execution time,
+    #  printing both lines in a single write
+    finish = [
+        f"########## Finished esxitools at {get_date(end_time)}-{get_time(end_time)}##########",
+        f"########## Total execution time: {end_time - start_time} ##########"
+    ]
+    for line in finish:
+        logging.info(line)
+    print("\n".join(finish))
 
 
 ###############################################################################
 # Functions                                                                   #
 ###############################################################################
-# Function that runs a command on an ESXI host and returns the output
-def esxi_command(host, user, password, command):
+# Function that runs the commands for all drives of a single ESXi host as one
+#  combined command, and returns the output and command status for every drive
+def query_host(server_key, rows, user, password):
+    results = []
     try:
-        # Start with storing negative command status and and empty output list
-        command_status = 'Not OK'
-        output = []
+        # All drives in rows belong to the same host, so the first row supplies the address
+        host = rows[0][1]
+
+        # Combining the commands for all drives into a single command, so the host only
+        #  needs one round-trip. After every drive a separator line gets echoed, together
+        #  with the exit status of the command for that drive. Stderr gets redirected on
+        #  the host, so error messages always end up before the separator of their drive
+        command = " ; ".join(f"{smart_command(row[2], row[3])} 2>&1 ; echo '{output_separator}' $?" for row in rows)
+
+        # Using the cached output for this host and command if it's recent enough.
+        #  Otherwise the command runs on the host
+        cache_key = f"{host}:{command}"
+        output = get_cached_output(cache_key)
+        cached = output is not None
+        if cached:
+            logging.info(f"########## Using cached output for {server_key} ##########")
+            command_status = 'OK'
+        else:
+            client = get_client(host, user, password)
+            output, command_status = esxi_command(client, command)
+
+        # Splitting the combined output back into the output and exit status for every
+        #  drive, in the same order as the commands
+        outputs = []
+        exit_statuses = []
+        drive_output = []
+        for line in output:
+            if line.startswith(output_separator):
+                outputs.append(drive_output)
+                exit_statuses.append(line[len(output_separator):].strip())
+                drive_output = []
+            else:
+                drive_output.append(line)
+
+        # If the output doesn't map back to the drives, none of the drives get a result.
+        #  When the command itself failed, its error has already been logged
+        if len(outputs) != len(rows):
+            if command_status == 'OK':
+                logging.error(f"########## Unexpected output for {server_key} ##########")
+            command_status = 'Not OK'
+            outputs = [[] for row in rows]
+            exit_statuses = [None for row in rows]
+
+        # The output only gets cached if the command for every drive succeeded, so
+        #  error messages never get reused as S.M.A.R.T. data
+        if not cached and command_status == 'OK' and all(status == '0' for status in exit_statuses):
+            store_cached_output(cache_key, output)
+
+        # Drives whose command failed get a negative command status
+        for row, drive_output, exit_status in zip(rows, outputs, exit_statuses):
+            drive_status = command_status
+            if command_status == 'OK' and exit_status != '0':
+                logging.error(f"########## Command for {row[0]}, drive {row[3]} exited with status {exit_status}: {' '.join(drive_output)} ##########")
+                drive_status = 'Not OK'
+            results.append((row, drive_output, drive_status))
+
+    except Exception as e:
+        logging.error(e)
+        print(e)
+
+        # Every drive that didn't get a result gets a negative command status
+        for row in rows[len(results):]:
+            results.append((row, [], 'Not OK'))
+
+    return server_key, results
+
+
+# Function that returns the command to retrieve S.M.A.R.T. data for a drive.
+#  The command depends on the drive type
+def smart_command(drive_type, drive_name):
+    match drive_type:
+        case 'NVME':
+            return f"esxcli nvme device log smart get -A {drive_name}"
+        case 'SATA' | 'DISK':
+            return f"esxcli storage core device smart get -d {drive_name}"
+
+
+# Function that returns an SSH connection to an ESXi host. The connection gets
+#  set up on first use and is reused from the SSH pool after that
+def get_client(host, user, password):
+    with ssh_pool_lock:
+        host_lock = ssh_pool_locks.setdefault((host, user), threading.Lock())
+
+    with host_lock:
+        with ssh_pool_lock:
+            client = ssh_pool.get((host, user))
+        if client:
+            return client
 
         # Setting up the Paramiko SSH client, allowing missing host keys
-        #  and initiating te connection
+        #  and initiating te connection. A failed connection gets closed
+        #  before the error is passed on
         client = paramiko.SSHClient()
         client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        client.connect(host, username=user, password=password)
+        try:
+            client.connect(host, username=user, password=password, **ssh_connect_options)
+        except Exception:
+            client.close()
+            raise
+
+        with ssh_pool_lock:
+            ssh_pool[(host, user)] = client
+        return client
+
+
+# Function that opens the response cache, which stores the command output per host
+#  on disk. Cached output is reused for ttl seconds
+def open_cache(cache_path, ttl):
+    global response_cache, cache_ttl
+    response_cache = shelve.open(cache_path)
+    cache_ttl = ttl
 
-        # Running the specified command on the target client, storing the output
-        stdin, stdout, stderr = client.exec_command(command)
 
-        # The output will get lost upon closing the connection, so the data
-        #  needs to be stored in a new variable
-        for line in stdout.readlines():
-            output.append(line)
+# Function that returns the cached output for a key, or None if there is no
+#  cached output or it's older than the TTL
+def get_cached_output(key):
+    if response_cache is None:
+        return None
+    with response_cache_lock:
+        entry = response_cache.get(key)
+    if entry and time.time() - entry[1] < cache_ttl:
+        return entry[0]
+    return None
 
-        # If this stage is reached, command status becomes positive, and
-        #  the status and output will be returned
+
+# Function that stores the output for a key in the response cache
+def store_cached_output(key, output):
+    if response_cache is None:
+        return
+    with response_cache_lock:
+        response_cache[key] = (output, time.time())
+
+
+# Function that closes the response cache
+def close_cache():
+    global response_cache
+    if response_cache is not None:
+        response_cache.close()
+        response_cache = None
+
+
+# Function that closes all SSH connections in the SSH pool
+def close_all():
+    with ssh_pool_lock:
+        for client in ssh_pool.values():
+            client.close()
+        ssh_pool.clear()
+        ssh_pool_locks.clear()
+
+
+# Function that runs a command on a connected ESXI host and returns the output
+def esxi_command(client, command):
+    # Start with storing negative command status and and empty output list
+    command_status = 'Not OK'
+    output = []
+
+    try:
+        # Running the specified command on the target client over a new channel.
+        #  Stderr gets combined with stdout, so there's only one stream to read
+        with client.get_transport().open_session() as channel:
+            channel.set_combine_stderr(True)
+            channel.exec_command(command)
+
+            # The output will get lost upon closing the channel, so the data
+            #  needs to be stored in a new variable in a single read
+            output = channel.makefile('rb').read().decode().splitlines()
+
+        # If this stage is reached, command status becomes positive
         command_status = 'OK'
-        return output, command_status
 
     except Exception as e:
         logging.error(e)
         print(e)
 
-    finally:
-        # Making sure the SSH connection to the target client always gets closed
-        if client:
-            client.close()
+    return output, command_status
+
+
+# Function that parses the S.M.A.R.T. output of an NVME drive. Every line gets split
+#  once into a property and a value, and the property is looked up in nvme_fields.
+#  Selected properties get converted and returned in a dictionary. Parsing stops
+#  once all properties have been found
+def parse_nvme(output):
+    smart_data = {}
+    needed = set(nvme_fields)
+    for line in output:
+        key, _, value = line.strip().partition(':')
+        field = nvme_fields.get(key)
+        if field:
+            smart_data[field[0]] = field[1](value)
+            needed.discard(key)
+            if not needed:
+                break
+    if smart_data['Available Spare (%)'] <= smart_data['Available Spare Threshold (%)']:
+        smart_data['Health Status'] = 'Not OK'
+    return smart_data
+
+
+# Function that parses the S.M.A.R.T. output of a SATA drive
+def parse_sata(output):
+    return parse_columns(output, sata_fields)
+
+
+# Function that parses the S.M.A.R.T. output of a DISK drive
+def parse_disk(output):
+    return parse_columns(output, disk_fields)
+
+
+# Function that parses the column based S.M.A.R.T. output of SATA and DISK drives.
+#  Every line gets partitioned once into a property and its columns, and the property
+#  is looked up in fields. Only the columns up to the selected one get split off.
+#  Selected properties get returned in a dictionary. Parsing stops once all properties
+#  have been found
+def parse_columns(output, fields):
+    smart_data = {}
+    needed = set(fields)
+    for line in output:
+        key, _, columns = line.strip().partition('  ')
+        field = fields.get(key)
+        if field:
+            smart_data[field[0]] = columns.split(None, field[1] + 1)[field[1]]
+            needed.discard(key)
+            if not needed:
+                break
+    return smart_data
+
+
+# Function that converts an NVME temperature in Kelvin to Celcius
+def kelvin_to_celcius(value):
+    return int(round(float(value.split()[0]) - 273.15))
+
+
+# Function that converts an NVME percentage like '100%' to an integer
+def percentage(value):
+    return int(value.split('%')[0].strip())
+
+
+# Function that converts an NVME hexadecimal value like '0x2d' to an integer
+def hex_to_int(value):
+    return int(value.strip()[2:], 16)
+
+
+# Function that returns a formatted date for a given datetime
+def get_date(timestamp):
+    return str(timestamp.date()).replace('-', '')
 
 
-# Function that returns a formatted date
-def get_date():
-    return str(datetime.now().date()).replace('-', '')
+# Function that returns a formatted time for a given datetime
+def get_time(timestamp):
+    return str(timestamp.time()).replace(':', '')[:6]
 
 
-# Function that returns a formatted time
-def get_time():
-    return str(datetime.now().time()).replace(':', '')[:6]
+# Function that configures the logging module to write to the log file. Log records
+#  get buffered in memory and written in batches, or right away for errors. The
+#  buffer gets flushed when the script exits
+def configure_logging(logfile):
+    file_handler = logging.FileHandler(logfile)
+    file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    memory_handler = logging.handlers.MemoryHandler(1024, flushLevel=logging.ERROR, target=file_handler)
+
+    logger = logging.getLogger()
+    logger.addHandler(memory_handler)
+    logger.setLevel(logging.INFO)
+    atexit.register(memory_handler.close)
 
 
 # Function that reads the CLI arguments and returns them as a dictionary
@@ -361,23 +577,29 @@ def read_args():
     return args
 
 
-# Function that reads a CSV file when given a path, and returns the contents
-#  as an array without the first (header) line of the CSV
+# Function that checks a CSV file when given a path, and returns a generator
+#  that streams the rows without the first (header) line of the CSV
 def load_csv_file(csv_path):
     # check if file exists
     if os.path.isfile(csv_path):
-        csv_content = []
-        with open(csv_path) as csv_file:
-            for line in csv.reader(csv_file, delimiter=';'):
-                csv_content.append(line)
-        csv_content.pop(0)
-        return csv_content
+        return read_csv_rows(csv_path)
     else:
         e = "########## Something wrong with csv_path ##########"
         logging.error(e)
         exit(e)
 
 
+# Generator that yields the rows of a CSV file one by one, skipping the header.
+#  The file stays open until all rows have been consumed. Parsing is done by the
+#  C implementation of the csv module, which reads the file without newline
+#  translation as the csv module expects
+def read_csv_rows(csv_path):
+    with open(csv_path, newline='') as csv_file:
+        reader = csv.reader(csv_file, delimiter=';')
+        next(reader, None)
+        yield from reader
+
+
 # Function that reads a .env file when given a path, and makes the
 #  variables in the .env file available for use
 def load_dotenv_file(env_path):
@@ -390,16 +612,35 @@ def load_dotenv_file(env_path):
         exit(e)
 
 
+# Function that converts a list of drive dictionaries to a dictionary of columns,
+#  holding a list with the values of every drive per report property. Drives
+#  that don't have a property get an empty value, so the report shows a blank cell
+def to_columns(drives):
+    return {key: [drive.get(key, '') for drive in drives] for key in report_properties}
+
+
+# Function that returns a Jinja2 environment for a template directory. The
+#  environment gets created on first use and is reused after that. Compiled
+#  templates are cached on disk, so they don't get parsed again on every run.
+#  Undefined variables raise an error, so a template that doesn't match the
+#  report variables fails instead of rendering an empty report
+def get_jinja_env(template_dir):
+    if template_dir not in jinja_envs:
+        jinja_envs[template_dir] = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(template_dir),
+            auto_reload=False,
+            undefined=jinja2.StrictUndefined,
+            bytecode_cache=jinja2.FileSystemBytecodeCache()
+        )
+    return jinja_envs[template_dir]
+
+
 # Function that renders the report
 def render_report(report_vars, template_path):
     try:
-        # Supplying the path to the Jinja2 report input file and reading the file
-        report_template_file = template_path
-        with open(report_template_file) as f:
-            report_template = f.read()
-
-        # Creating a Jinja2 object with the template file
-        template = jinja2.Template(report_template)
+        # Loading the Jinja2 report template from the cached environment
+        env = get_jinja_env(os.path.dirname(os.path.abspath(template_path)))
+        template = env.get_template(os.path.basename(template_path))
 
         # Rendering the report by combining the template with the variables,
         #  then returning the rendered report
@@ -411,8 +652,28 @@ def render_report(report_vars, template_path):
         print(e)
 
 
-# Function that e-mails the report
-def send_mail(mail_vars):
+# Function that sets up and returns an authenticated SMTP connection. Port 465
+#  uses implicit TLS, other ports use STARTTLS
+def connect_mail(mail_vars):
+    try:
+        if mail_vars['smtp_port'] and int(mail_vars['smtp_port']) == 465:
+            mailserver = smtplib.SMTP_SSL(mail_vars['smtp_host'], mail_vars['smtp_port'])
+        else:
+            mailserver = smtplib.SMTP(mail_vars['smtp_host'], mail_vars['smtp_port'])
+            mailserver.ehlo()
+            mailserver.starttls()
+        mailserver.login(mail_vars['smtp_user'], mail_vars['smtp_pass'])
+        return mailserver
+
+    except Exception as e:
+        logging.error(e)
+        print(e)
+
+
+# Function that e-mails the report. An SMTP connection that was set up before can
+#  be supplied. If there is none or it got closed in the meantime, for instance by
+#  a server timeout, a new connection gets set up
+def send_mail(mail_vars, mailserver=None):
     try:
         # Creating the e-mail object with HTML Support
         mail = MIMEMultipart('alternative')
@@ -433,12 +694,22 @@ def send_mail(mail_vars):
         mail.attach(part1)
         mail.attach(part2)
 
+        # Checking the SMTP connection, setting up a new one if needed
+        try:
+            if mailserver:
+                mailserver.noop()
+        except (smtplib.SMTPException, OSError):
+            mailserver = None
+        if not mailserver:
+            mailserver = connect_mail(mail_vars)
+        if not mailserver:
+            e = "########## Could not connect to the SMTP server, the report was not sent ##########"
+            logging.error(e)
+            print(e)
+            return
+
         # Sending the e-mail object via SMTP
-        mailserver = smtplib.SMTP(mail_vars['smtp_host'], mail_vars['smtp_port'])
-        mailserver.ehlo()
-        mailserver.starttls()
-        mailserver.login(mail_vars['smtp_user'], mail_vars['smtp_pass'])
-        mailserver.sendmail(mail_vars['from'], mail_vars['to'], mail.as_string())
+        mailserver.send_message(mail)
         mailserver.quit()
 
     except Exception as e:
@@ -446,6 +717,67 @@ def send_mail(mail_vars):
         print(e)
 
 
+###############################################################################
+# Parser tables                                                               #
+###############################################################################
+# Storing the NVME S.M.A.R.T. properties to retrieve. Every property in the esxcli
+#  output maps to the name it gets in the report, and the function that converts
+#  its value
+nvme_fields = {
+    'NVM Subsystem Reliability Degradation': ('NVM Subsystem Reliability Degradation', str.strip),
+    'Volatile Memory Backup Device Failure': ('Volatile Memory Backup Device Failure', str.strip),
+    'Composite Temperature': ('Drive Temperature (Celcius)', kelvin_to_celcius),
+    'Available Spare': ('Available Spare (%)', percentage),
+    'Available Spare Threshold': ('Available Spare Threshold (%)', percentage),
+    'Percentage Used': ('Percentage Used (%)', percentage),
+    'Unsafe Shutdowns': ('Unsafe Shutdowns', hex_to_int),
+    'Media Errors': ('Media Errors', hex_to_int),
+    'Number of Error Info Log Entries': ('Number of Error Info Log Entries', hex_to_int)
+}
+
+# Storing the SATA and DISK S.M.A.R.T. properties to retrieve. Every property in the
+#  esxcli output maps to the name it gets in the report, and the index of the column
+#  that holds its value (0 for Value, 3 for Raw). Columns are separated by at least
+#  two spaces, the words of a property by single spaces
+sata_fields = {
+    'Health Status': ('Health Status', 0),
+    'Drive Temperature': ('Drive Temperature (Celcius)', 3),
+    'Media Wearout Indicator': ('Media Wearout Indicator', 3),
+    'Reallocated Sector Count': ('Reallocated Sector Count', 3),
+    'Write Sectors TOT Count': ('Write Sectors TOT Count', 3),
+    'Read Sectors TOT Count': ('Read Sectors TOT Count', 3),
+    'Initial Bad Block Count': ('Initial Bad Block Count', 3),
+    'Program Fail Count': ('Program Fail Count', 3),
+    'Erase Fail Count': ('Erase Fail Count', 3),
+    'Uncorrectable Error Count': ('Uncorrectable Error Count', 3),
+    'Pending Sector Reallocation Count': ('Pending Sector Reallocation Count', 3)
+}
+disk_fields = {
+    'Health Status': ('Health Status', 0),
+    'Drive Temperature': ('Drive Temperature (Celcius)', 3),
+    'Read Error Count': ('Read Error Count', 3),
+    'Reallocated Sector Count': ('Reallocated Sector Count', 3),
+    'Sector Reallocation Event Count': ('Sector Reallocation Event Count', 3),
+    'Pending Sector Reallocation Count': ('Pending Sector Reallocation Count', 3),
+    'Uncorrectable Sector Count': ('Uncorrectable Sector Count', 3)
+}
+
+# Storing the properties that every drive gets a column for in the report, in the
+#  order they first appear in the field tables
+report_properties = list(dict.fromkeys(
+    ['Drive Type', 'Drive Name', 'Health Status']
+    + [field[0] for fields in (nvme_fields, sata_fields, disk_fields) for field in fields.values()]
+))
+
+# Storing the parser function for every drive type. The parsers return a
+#  dictionary with the S.M.A.R.T. properties of the drive
+parsers = {
+    'NVME': parse_nvme,
+    'SATA': parse_sata,
+    'DISK': parse_disk
+}
+
+
 # Making sure main() gets executed when script is called
 if __name__ == '__main__':
     main()